@@ -1,13 +1,13 @@
 import os
 import re
-import base64
-import subprocess
-import tempfile
+import asyncio
+import binascii
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple, Set
+from typing import Any, Awaitable, Callable, List, Dict, NamedTuple, Optional, Tuple, Set
 
-from nonebot import on_command, on_regex, logger, get_bots
+from nonebot import on_command, on_regex, logger, get_bots, get_driver, get_plugin_config
 from nonebot.adapters.onebot.v11 import Bot, GroupMessageEvent, Message, MessageSegment
+from nonebot.params import CommandArg
 from nonebot.plugin import PluginMetadata
 from nonebot.permission import SUPERUSER
 from nonebot.adapters.onebot.v11.permission import GROUP_ADMIN, GROUP_OWNER
@@ -18,6 +18,11 @@ from .config import Config
 import json
 import random
 import difflib
+import functools
+import shutil
+import hashlib
+import heapq
+from collections import OrderedDict
 
 try:
     from pypinyin import lazy_pinyin, Style
@@ -25,6 +30,37 @@ try:
 except Exception:
     _PYPINYIN_AVAILABLE = False
 
+try:
+    import orjson
+    _ORJSON_AVAILABLE = True
+except Exception:
+    _ORJSON_AVAILABLE = False
+
+try:
+    from rapidfuzz import fuzz, process as rf_process
+    _RAPIDFUZZ_AVAILABLE = True
+except Exception:
+    _RAPIDFUZZ_AVAILABLE = False
+
+try:
+    # RapidFuzz 的 cdist 以 NumPy 数组返回结果
+    import numpy
+    _NUMPY_AVAILABLE = True
+except Exception:
+    _NUMPY_AVAILABLE = False
+
+try:
+    from caio import AsyncioContext
+    _CAIO_AVAILABLE = True
+except Exception:
+    _CAIO_AVAILABLE = False
+
+try:
+    from watchfiles import awatch
+    _WATCHFILES_AVAILABLE = True
+except Exception:
+    _WATCHFILES_AVAILABLE = False
+
 try:
     from nonebot_plugin_apscheduler import scheduler
     _SCHEDULER_AVAILABLE = True
@@ -51,13 +87,50 @@ __plugin_meta__ = PluginMetadata(
     config=Config,
 )
 
-# 音乐文件映射
-music_files: Dict[int, Dict[str, str]] = {}
+
+class MusicEntry(NamedTuple):
+    """单首音乐的扫描信息（序号即其在 music_files 中的下标）"""
+    title: str
+    path: str
+    filename: str
+    size: int
+    mtime_ns: int
+    # 搜索用的标题特征，扫描时预先计算
+    norm: str
+    pinyin: str
+    initials: str
+
+
+# 音乐文件列表（序号从 0 开始连续）
+music_files: List[MusicEntry] = []
 music_data_path = Path(__file__).parent / "music_data"
+# 支持的音频格式（不含点）
+_AUDIO_EXTS = frozenset(('mp3', 'wav', 'flac', 'm4a', 'ogg', 'aac'))
+# 等待转码的条目：(序号, 源文件路径, 源文件 mtime_ns, 转码输出路径)
+_pending_transcodes: List[Tuple[int, str, int, str]] = []
+# 转码失败的源文件：(路径, mtime_ns)，文件修改前不再重试
+_failed_transcodes: Set[Tuple[str, int]] = set()
+# 歌单行文本（"序号: 标题"），每次扫描时预先生成
+_playlist_lines: List[str] = []
+# 与 music_files 下标对齐的标题特征列表，供批量相似度计算
+_titles_norm: List[str] = []
+_titles_py: List[str] = []
+_titles_ini: List[str] = []
+# 文件名到序号的映射与全部文件名，供排行榜使用
+_filename_to_index: Dict[str, int] = {}
+_all_filenames: List[str] = []
+# 可直接发送（不超过大小上限）的曲目序号，随机播放与定时推送从中挑选
+_playable_indices: List[int] = []
+# 从未被点播过的文件名，扫描时重建，点播时增量移除；排行榜补位直接从中抽取。
+# 用列表加位置映射保存：移除时与末尾交换后弹出，random.sample 可直接作用于列表而无需复制
+_never_played: List[str] = []
+_never_played_pos: Dict[str, int] = {}
 
 # 播放计数（按文件名持久化，避免序号变化导致错位）
 data_dir = Path(__file__).parent / "data"
 data_dir.mkdir(parents=True, exist_ok=True)
+# 非 MP3 音乐的预转码缓存（文件名由源路径与 mtime 决定，重复转码直接复用）
+transcode_cache_path = data_dir / "transcode_cache"
 play_counts_file = data_dir / "play_counts.json"
 play_counts_by_filename: Dict[str, int] = {}
 
@@ -66,20 +139,32 @@ push_groups_file = data_dir / "push_groups.json"
 enabled_push_groups: Set[int] = set()
 
 
+def _json_loads(data: bytes) -> Any:
+    if _ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data.decode("utf-8"))
+
+
+def _json_dumps(obj: Any) -> bytes:
+    """序列化为缩进 2 的 UTF-8 JSON（不转义中文）。"""
+    if _ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+
 def load_play_counts() -> None:
     """加载历史播放计数（按文件名）。"""
     global play_counts_by_filename
     if play_counts_file.exists():
         try:
-            with open(play_counts_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    # 仅保留 int 计数
-                    play_counts_by_filename = {
-                        str(k): int(v) for k, v in data.items() if isinstance(v, (int, float))
-                    }
+            data = _json_loads(play_counts_file.read_bytes())
+            if isinstance(data, dict):
+                # 仅保留 int 计数
+                play_counts_by_filename = {
+                    str(k): int(v) for k, v in data.items() if isinstance(v, (int, float))
+                }
         except Exception as e:
-            logger.warning(f"加载播放计数失败，将重置：{e}")
+            logger.warning("加载播放计数失败，将重置：{}", e)
             play_counts_by_filename = {}
     else:
         play_counts_by_filename = {}
@@ -89,27 +174,48 @@ def save_play_counts() -> None:
     """安全保存播放计数。"""
     try:
         tmp_path = play_counts_file.with_suffix(".tmp")
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(play_counts_by_filename, f, ensure_ascii=False, indent=2)
+        tmp_path.write_bytes(_json_dumps(play_counts_by_filename))
         os.replace(tmp_path, play_counts_file)
     except Exception as e:
-        logger.error(f"保存播放计数失败：{e}")
+        logger.error("保存播放计数失败：{}", e)
+
+
+# 计数变化后延迟一段时间合并写盘，关闭时再补写一次
+_COUNTS_FLUSH_DELAY = 5.0
+_counts_dirty = False
+_counts_flush_handle: Optional[asyncio.TimerHandle] = None
+
+
+def flush_play_counts() -> None:
+    """计数有变化时写盘。"""
+    global _counts_dirty, _counts_flush_handle
+    _counts_flush_handle = None
+    if _counts_dirty:
+        _counts_dirty = False
+        save_play_counts()
+
+
+def mark_play_counts_dirty() -> None:
+    """标记计数已变化，并安排一次延迟写盘（期间的多次点播合并为一次写入）。"""
+    global _counts_dirty, _counts_flush_handle
+    _counts_dirty = True
+    if _counts_flush_handle is None:
+        _counts_flush_handle = asyncio.get_running_loop().call_later(_COUNTS_FLUSH_DELAY, flush_play_counts)
 
 
 def load_push_groups() -> None:
     global enabled_push_groups
     if push_groups_file.exists():
         try:
-            with open(push_groups_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, list):
-                    enabled_push_groups = {int(gid) for gid in data}
-                elif isinstance(data, dict) and "groups" in data:
-                    enabled_push_groups = {int(gid) for gid in data.get("groups", [])}
-                else:
-                    enabled_push_groups = set()
+            data = _json_loads(push_groups_file.read_bytes())
+            if isinstance(data, list):
+                enabled_push_groups = {int(gid) for gid in data}
+            elif isinstance(data, dict) and "groups" in data:
+                enabled_push_groups = {int(gid) for gid in data.get("groups", [])}
+            else:
+                enabled_push_groups = set()
         except Exception as e:
-            logger.warning(f"加载推送群列表失败，将重置：{e}")
+            logger.warning("加载推送群列表失败，将重置：{}", e)
             enabled_push_groups = set()
     else:
         enabled_push_groups = set()
@@ -118,86 +224,116 @@ def load_push_groups() -> None:
 def save_push_groups() -> None:
     try:
         tmp_path = push_groups_file.with_suffix(".tmp")
-        with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(sorted(list(enabled_push_groups)), f, ensure_ascii=False, indent=2)
+        tmp_path.write_bytes(_json_dumps(sorted(enabled_push_groups)))
         os.replace(tmp_path, push_groups_file)
     except Exception as e:
-        logger.error(f"保存推送群列表失败：{e}")
+        logger.error("保存推送群列表失败：{}", e)
 
 
 # 文本归一化与匹配工具
 _non_cjk_alnum_space = re.compile(r"[^\u4e00-\u9fffA-Za-z0-9]+")
-_spaces = re.compile(r"\s+")
+# 纯 ASCII 文本（已转小写）直接删掉字母数字以外的字符，不必进正则引擎
+_ASCII_STRIP_TABLE = dict.fromkeys(
+    c for c in range(128) if not (ord("a") <= c <= ord("z") or ord("0") <= c <= ord("9"))
+)
+# 点歌参数：只能是序号本身
+_PLAY_RE = re.compile(r"\s*(\d+)\s*")
+# 搜索命令前缀、排行榜末尾页码
+_SEARCH_STRIP_RE = re.compile(r"^\s*/?\s*(哈基米搜索|搜索|hachimi_search)\s*")
+_TRAILING_DIGITS_RE = re.compile(r"(\d+)$")
 
 
+@functools.lru_cache(maxsize=4096)
 def normalize_text(text: str) -> str:
     if not text:
         return ""
     text = str(text).lower()
-    # 去除特殊符号（保留中文、英文字母和数字）
-    text = _non_cjk_alnum_space.sub(" ", text)
-    # 合并并去空白
-    text = _spaces.sub("", text)
-    return text
-
+    if text.isascii():
+        return text.translate(_ASCII_STRIP_TABLE)
+    # 去除特殊符号与空白（保留中文、英文字母和数字）
+    return _non_cjk_alnum_space.sub("", text)
+
+
+# 拼音实现按 pypinyin 是否可用在导入时选定一次，调用时不再检查
+if _PYPINYIN_AVAILABLE:
+    @functools.lru_cache(maxsize=4096)
+    def text_to_pinyin(text: str) -> str:
+        if not text:
+            return ""
+        try:
+            return "".join(lazy_pinyin(text))
+        except Exception:
+            return ""
 
-def text_to_pinyin(text: str) -> str:
-    if not _PYPINYIN_AVAILABLE or not text:
-        return ""
-    try:
-        return "".join(lazy_pinyin(text))
-    except Exception:
+    @functools.lru_cache(maxsize=4096)
+    def text_to_pinyin_initials(text: str) -> str:
+        if not text:
+            return ""
+        try:
+            return "".join(lazy_pinyin(text, style=Style.FIRST_LETTER))
+        except Exception:
+            return ""
+else:
+    def text_to_pinyin(text: str) -> str:
         return ""
 
-
-def text_to_pinyin_initials(text: str) -> str:
-    if not _PYPINYIN_AVAILABLE or not text:
-        return ""
-    try:
-        initials = lazy_pinyin(text, style=Style.FIRST_LETTER)
-        return "".join(initials)
-    except Exception:
+    def text_to_pinyin_initials(text: str) -> str:
         return ""
 
 
-def try_regex_match(pattern: str, candidates: List[str]) -> bool:
+@functools.lru_cache(maxsize=256)
+def compile_user_regex(pattern: str) -> Optional["re.Pattern[str]"]:
+    """编译用户输入的正则（忽略大小写），非法时返回 None；结果按模式串缓存"""
     if not pattern:
-        return False
+        return None
     try:
-        compiled = re.compile(pattern, re.IGNORECASE)
+        return re.compile(pattern, re.IGNORECASE)
     except Exception:
-        return False
-    for c in candidates:
-        if not c:
-            continue
-        if compiled.search(c):
-            return True
-    return False
-
+        return None
 
-def similarity_ratio(a: str, b: str) -> float:
-    if not a or not b:
-        return 0.0
-    return difflib.SequenceMatcher(a=a, b=b).ratio()
 
+# 候选数达到该值时才启用多线程的 cdist
+_CDIST_MIN_CHOICES = 2000
 
-def compute_match_score(query: str, title: str) -> float:
-    if not query or not title:
-        return 0.0
-
-    q_norm = normalize_text(query)
-    t_norm = normalize_text(title)
-
-    q_py = text_to_pinyin(query)
-    t_py = text_to_pinyin(title)
-
-    q_ini = text_to_pinyin_initials(query)
-    t_ini = text_to_pinyin_initials(title)
 
+def batch_similarity(query: str, choices: List[str]) -> List[float]:
+    """query 与每个候选的相似度（0~1），有 RapidFuzz 时一次 C 调用完成"""
+    if not query:
+        return [0.0] * len(choices)
+    if not _RAPIDFUZZ_AVAILABLE:
+        # 复用同一个 SequenceMatcher：query 作为 seq2，其 b2j 索引只建一次，每个候选只需 set_seq1。
+        # difflib 的 ratio 并不对称，结果与 SequenceMatcher(a=query, b=标题) 略有出入；
+        # 关闭 autojunk，避免长查询中的高频字符被当作噪声忽略
+        matcher = difflib.SequenceMatcher(b=query, autojunk=False)
+        sims = [0.0] * len(choices)
+        for idx, c in enumerate(choices):
+            if c:
+                matcher.set_seq1(c)
+                sims[idx] = matcher.ratio()
+        return sims
+    if _NUMPY_AVAILABLE and len(choices) >= _CDIST_MIN_CHOICES:
+        # 曲库较大时用 cdist 释放 GIL 多核计算；曲库小时线程调度开销反而更大
+        scores = rf_process.cdist(
+            [query], choices, scorer=fuzz.ratio, processor=None, dtype=numpy.float64, workers=-1
+        )[0]
+        return [score / 100.0 if c else 0.0 for score, c in zip(scores.tolist(), choices)]
+    sims = [0.0] * len(choices)
+    for _, score, idx in rf_process.extract(query, choices, scorer=fuzz.ratio, processor=None, limit=None):
+        # 空标题不计相似度
+        if choices[idx]:
+            sims[idx] = score / 100.0
+    return sims
+
+
+def keyword_match_score(
+    q_norm: str, q_py: str, q_ini: str, q_regex: Optional["re.Pattern[str]"],
+    title: str, t_norm: str, t_py: str, t_ini: str,
+) -> float:
+    """匹配分数中的正则与子串部分（不含相似度）"""
     score = 0.0
 
     # 正则匹配（对原始、规范化、拼音）
-    if try_regex_match(query, [title, t_norm, t_py]):
+    if q_regex is not None and any(q_regex.search(c) for c in (title, t_norm, t_py) if c):
         score += 1.2
 
     # 规范化子串匹配
@@ -212,72 +348,407 @@ def compute_match_score(query: str, title: str) -> float:
     if q_ini and q_ini in t_ini:
         score += 0.85
 
-    # 相似度
-    score += similarity_ratio(q_norm, t_norm) * 0.8
-    score += similarity_ratio(q_py, t_py) * 0.6
-    score += similarity_ratio(q_ini, t_ini) * 0.5
-
     return score
 
 
+# 语音消息允许发送的文件大小上限（10MB）
+_MAX_SEND_SIZE = 10 * 1024 * 1024
+
+# base64 兜底发送的文件大小上限，更大的文件编码后会占用过多内存（可通过 HACHIMI_BASE64_MAX_SIZE 配置）
+_B64_FALLBACK_MAX_SIZE = get_plugin_config(Config).hachimi_base64_max_size
+
+
+# base64 结果缓存：(路径, mtime_ns, 大小) -> base64，文件变化后键随之变化
+_b64_cache: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+# 缓存按编码后的总长度限制（约 22MB），base64 上限调大后也不会随之膨胀；但至少能容纳一个最大的结果
+_B64_CACHE_MAX_BYTES = max(22 * 1024 * 1024, (_B64_FALLBACK_MAX_SIZE + 2) // 3 * 4)
+_b64_cache_bytes = 0
+_aio_context = None
+
+
+# 分块读取大小，取 3 的倍数使各块 base64 结果可直接拼接
+_B64_CHUNK_SIZE = 48 * 1024
+
+
+def _encode_file_b64(path: str) -> str:
+    """分块读取并编码文件为 base64（阻塞操作，应放到线程中执行）
+
+    各块编码后即解码为 str，只保留编码结果，峰值约为文件大小的 2.7 倍。
+    """
+    with open(path, "rb") as f:
+        return "".join(
+            binascii.b2a_base64(chunk, newline=False).decode("ascii")
+            for chunk in iter(functools.partial(f.read, _B64_CHUNK_SIZE), b"")
+        )
+
+
+def _encode_buffer_b64(buf: bytearray) -> str:
+    """分块编码已读入的文件内容，编码完即清空 buf 释放原始数据（阻塞操作，应放到线程中执行）"""
+    with memoryview(buf) as view:
+        parts = [
+            binascii.b2a_base64(view[pos:pos + _B64_CHUNK_SIZE], newline=False).decode("ascii")
+            for pos in range(0, len(view), _B64_CHUNK_SIZE)
+        ]
+    buf.clear()
+    return "".join(parts)
+
+
+async def _read_file_aio(path: str) -> bytearray:
+    """通过 caio 分块读取到文件末尾（只负责读取，编码交给线程）
+
+    缓冲区按打开后的实际大小预先分配，文件在扫描后被替换时与线程方式读到的内容一致。
+    """
+    global _aio_context
+    if _aio_context is None:
+        _aio_context = AsyncioContext(max_requests=32)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        buf = bytearray(os.fstat(fd).st_size)
+        pos = 0
+        while True:
+            chunk = await _aio_context.read(_B64_CHUNK_SIZE, fd, pos)
+            if not chunk:
+                break
+            buf[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+        # 文件在 fstat 之后被截短时去掉多余部分（变长时切片赋值已自动扩展）
+        del buf[pos:]
+        return buf
+    finally:
+        os.close(fd)
+
+
+def _clear_b64_cache() -> None:
+    global _b64_cache_bytes
+    _b64_cache.clear()
+    _b64_cache_bytes = 0
+
+
+async def _read_b64(info: MusicEntry) -> str:
+    """读取音频文件并编码为 base64，最近使用的结果会被缓存（键取自扫描时的 stat，无需再次 stat）"""
+    global _b64_cache_bytes
+    key = (info.path, info.mtime_ns, info.size)
+    cached = _b64_cache.get(key)
+    if cached is not None:
+        _b64_cache.move_to_end(key)
+        return cached
+
+    # 编码始终在线程中进行，不占用事件循环；有 caio 时读取走异步文件 IO
+    if _CAIO_AVAILABLE:
+        buf = await _read_file_aio(info.path)
+        encoded = await asyncio.to_thread(_encode_buffer_b64, buf)
+    else:
+        encoded = await asyncio.to_thread(_encode_file_b64, info.path)
+    if key not in _b64_cache:
+        _b64_cache[key] = encoded
+        _b64_cache_bytes += len(encoded)
+        # 超出总长度上限时淘汰最久未用的结果
+        while _b64_cache_bytes > _B64_CACHE_MAX_BYTES:
+            _, old = _b64_cache.popitem(last=False)
+            _b64_cache_bytes -= len(old)
+    return encoded
+
+
+# 限制同时运行的 ffmpeg 进程数，每个进程再限制为 2 个线程。
+# 信号量在首次使用时于事件循环内创建：Python 3.9 的信号量会绑定创建时的事件循环
+_FFMPEG_CONCURRENCY = max(1, (os.cpu_count() or 4) // 4)
+_ffmpeg_sem: Optional[asyncio.Semaphore] = None
+
+
+def _get_ffmpeg_sem() -> asyncio.Semaphore:
+    global _ffmpeg_sem
+    if _ffmpeg_sem is None:
+        _ffmpeg_sem = asyncio.Semaphore(_FFMPEG_CONCURRENCY)
+    return _ffmpeg_sem
+
+
+# 预转码需要 ffmpeg 与 ffprobe，导入时检查一次；缺少时非 MP3 音乐直接以原文件发送
+_FFMPEG_AVAILABLE = shutil.which("ffmpeg") is not None and shutil.which("ffprobe") is not None
+if not _FFMPEG_AVAILABLE:
+    logger.info("未检测到 ffmpeg/ffprobe，跳过非 MP3 音乐的预转码，将以原文件发送")
+
+
+# ffprobe 探测结果缓存：(路径, mtime_ns) -> 音频编码名
+_codec_cache: Dict[Tuple[str, int], str] = {}
+
+
+async def probe_audio_codec(input_path: str) -> str:
+    """用 ffprobe 获取首条音频流的编码名，失败时返回空字符串"""
+    try:
+        key = (input_path, os.stat(input_path).st_mtime_ns)
+        if key in _codec_cache:
+            return _codec_cache[key]
+        proc = await asyncio.create_subprocess_exec(
+            'ffprobe', '-v', 'error', '-select_streams', 'a:0',
+            '-show_streams', '-of', 'json', input_path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        out, _ = await proc.communicate()
+        streams = _json_loads(out or b"{}").get("streams") or [{}]
+        codec = str(streams[0].get("codec_name", ""))
+        _codec_cache[key] = codec
+        return codec
+    except Exception as e:
+        logger.warning("探测音频编码失败: {}", e)
+        return ""
+
+
+def transcode_output_path(input_path: str, mtime_ns: int) -> Path:
+    """源文件对应的转码缓存路径，源文件修改后 mtime 变化即对应新的缓存"""
+    key = hashlib.sha1(f"{input_path}:{mtime_ns}".encode("utf-8")).hexdigest()
+    return transcode_cache_path / f"{key}.mp3"
+
+
+# 进行中的转码：输出路径 -> 任务。重复扫描排到同一输出时等待已有任务，避免两个 ffmpeg 写同一文件
+_inflight_transcodes: Dict[str, "asyncio.Task[str]"] = {}
+
+
+async def _run_ffmpeg_transcode(input_path: str, output_path: str) -> str:
+    # 先写入临时文件再替换，避免中断后留下不完整的缓存
+    part_path = output_path + ".part"
+    try:
+        # ffprobe 与 ffmpeg 一起占用并发名额，避免批量转码时同时拉起大量探测进程
+        async with _get_ffmpeg_sem():
+            # 使用ffmpeg转换音频；音频流本身已是 MP3 时只做封装转换，不重新编码
+            if await probe_audio_codec(input_path) == "mp3":
+                codec_args = ['-vn', '-c:a', 'copy']
+            else:
+                codec_args = ['-acodec', 'libmp3lame', '-ab', '128k', '-threads', '2']
+            cmd = ['ffmpeg', '-i', input_path, *codec_args, '-f', 'mp3', '-y', part_path]
+
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                _, err = await proc.communicate()
+            except asyncio.CancelledError:
+                # 关闭时被取消，结束 ffmpeg 进程，不让它在插件退出后继续运行
+                proc.kill()
+                await proc.wait()
+                raise
+
+        if proc.returncode == 0:
+            os.replace(part_path, output_path)
+            logger.info("音频转换成功: {} -> {}", input_path, output_path)
+            return output_path
+        logger.error("音频转换失败: {}", err.decode('utf-8', errors='replace'))
+        return input_path
+    except Exception as e:
+        logger.error("音频转换异常: {}", e)
+        return input_path
+    finally:
+        # 失败或被取消时清掉残留的临时文件（成功时已被 os.replace 移走）
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+
+
+async def convert_audio_to_mp3(input_path: str, output_path: Optional[str] = None) -> str:
+    """将音频文件转换为MP3格式（默认输出到转码缓存目录，已转码过则直接复用）"""
+    # 已是 MP3 无需转换
+    if input_path.lower().endswith(".mp3"):
+        return input_path
+    try:
+        if output_path is None:
+            output_path = str(transcode_output_path(input_path, os.stat(input_path).st_mtime_ns))
+        if os.path.exists(output_path):
+            return output_path
+    except Exception as e:
+        logger.error("音频转换异常: {}", e)
+        return input_path
+
+    task = _inflight_transcodes.get(output_path)
+    if task is None:
+        task = asyncio.ensure_future(_run_ffmpeg_transcode(input_path, output_path))
+        _inflight_transcodes[output_path] = task
+        task.add_done_callback(lambda _t, key=output_path: _inflight_transcodes.pop(key, None))
+    # shield：某个等待方被取消时不影响其他等待同一转码的调用
+    return await asyncio.shield(task)
+
+
+async def transcode_music_files() -> None:
+    """将扫描时排队的非 MP3 音乐并发转码到缓存目录，并把条目指向转码结果"""
+    global _pending_transcodes
+    pending, _pending_transcodes = _pending_transcodes, []
+    if not pending:
+        return
+
+    logger.info("开始预转码 {} 首非 MP3 音乐", len(pending))
+    results = await asyncio.gather(*(convert_audio_to_mp3(src, dst) for _, src, _, dst in pending))
+    for (index, src, src_mtime_ns, dst), out in zip(pending, results):
+        if out != dst:
+            # 记下失败的文件，重新扫描时不再反复转码，直到文件被修改
+            _failed_transcodes.add((src, src_mtime_ns))
+            continue
+        # 转码期间可能已重新扫描，序号不再对应同一文件时跳过
+        if index >= len(music_files) or music_files[index].path != src:
+            continue
+        try:
+            st = os.stat(dst)
+        except OSError:
+            # 源文件在转码期间被修改，重新扫描时已把这份结果当作过期缓存删掉
+            continue
+        music_files[index] = music_files[index]._replace(path=dst, size=st.st_size, mtime_ns=st.st_mtime_ns)
+    # 转码后大小变化，重新划定可发送范围
+    _refresh_playable_indices()
+
+
+def _ensure_transcode_cache_dir() -> bool:
+    """创建转码缓存目录，失败时返回 False（此时跳过预转码，直接发送源文件）"""
+    try:
+        transcode_cache_path.mkdir(parents=True, exist_ok=True)
+        return True
+    except OSError as e:
+        logger.warning("无法创建转码缓存目录，跳过预转码：{}", e)
+        return False
+
+
+def _refresh_playable_indices() -> None:
+    global _playable_indices
+    _playable_indices = [idx for idx, info in enumerate(music_files) if info.size <= _MAX_SEND_SIZE]
+
+
+def _discard_never_played(filename: str) -> None:
+    """把首次被点播的歌曲移出未点播列表（与末尾元素交换后弹出，O(1)）"""
+    pos = _never_played_pos.pop(filename, None)
+    if pos is None:
+        return
+    last = _never_played.pop()
+    if last != filename:
+        _never_played[pos] = last
+        _never_played_pos[last] = pos
+
+
 def load_music_files():
     """加载music_data文件夹中的音乐文件"""
-    global music_files
-    music_files.clear()
-    
+    global music_files, _playlist_lines, _pending_transcodes
+    global _titles_norm, _titles_py, _titles_ini, _filename_to_index, _all_filenames
+    global _never_played, _never_played_pos
+    global _playable_indices
+
     if not music_data_path.exists():
+        music_files.clear()
+        _playlist_lines = []
+        _titles_norm, _titles_py, _titles_ini = [], [], []
+        _filename_to_index, _all_filenames = {}, []
+        _never_played, _never_played_pos = [], {}
+        _playable_indices = []
         music_data_path.mkdir(parents=True, exist_ok=True)
-        logger.info(f"创建音乐数据目录: {music_data_path}")
+        logger.info("创建音乐数据目录: {}", music_data_path)
         return
-    
-    # 支持的音频格式
-    audio_extensions = {'.mp3', '.wav', '.flac', '.m4a', '.ogg', '.aac'}
-    
-    index = 0
-    for file_path in music_data_path.iterdir():
-        if file_path.is_file() and file_path.suffix.lower() in audio_extensions:
-            # 从文件名提取标题（去掉扩展名）
-            title = file_path.stem
-            music_files[index] = {
-                'title': title,
-                'path': str(file_path),
-                'filename': file_path.name
-            }
-            index += 1
-    
-    logger.info(f"加载了 {len(music_files)} 首音乐文件")
 
-# 初始化时加载音乐文件
-load_music_files()
-# 加载播放计数
+    music_files.clear()
+    _clear_b64_cache()
+    # 缓存目录可能在运行中被删除，每次扫描前补建
+    cache_ok = _ensure_transcode_cache_dir()
+    pending: List[Tuple[int, str, int, str]] = []
+    expected_cache: Set[str] = set()
+    still_failed: Set[Tuple[str, int]] = set()
+    with os.scandir(music_data_path) as it:
+        for entry in it:
+            # DirEntry 自带文件类型缓存，只对音频文件做一次 stat 取大小
+            stem, _, ext = entry.name.rpartition('.')
+            ext = ext.lower()
+            if not stem or ext not in _AUDIO_EXTS or not entry.is_file():
+                continue
+            st = entry.stat()
+            info = MusicEntry(
+                stem, entry.path, entry.name, st.st_size, st.st_mtime_ns,
+                normalize_text(stem), text_to_pinyin(stem), text_to_pinyin_initials(stem),
+            )
+            if ext != "mp3" and cache_ok:
+                # 已有对应的转码结果则直接使用，否则排队转码（缺少 ffmpeg 或此前转码失败时不排队）
+                cached_mp3 = transcode_output_path(entry.path, st.st_mtime_ns)
+                expected_cache.add(cached_mp3.name)
+                try:
+                    cached_st = cached_mp3.stat()
+                    info = info._replace(path=str(cached_mp3), size=cached_st.st_size, mtime_ns=cached_st.st_mtime_ns)
+                except OSError:
+                    failed_key = (entry.path, st.st_mtime_ns)
+                    if failed_key in _failed_transcodes:
+                        still_failed.add(failed_key)
+                    elif _FFMPEG_AVAILABLE:
+                        pending.append((len(music_files), entry.path, st.st_mtime_ns, str(cached_mp3)))
+            music_files.append(info)
+
+    # 已删除或修改过的文件不再记为失败
+    _failed_transcodes.intersection_update(still_failed)
+
+    # 清理已不对应任何源文件的旧转码结果（缓存目录只存放本插件生成的文件）
+    if cache_ok:
+        with os.scandir(transcode_cache_path) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.removesuffix(".part") not in expected_cache:
+                    try:
+                        os.remove(entry.path)
+                    except OSError as e:
+                        logger.warning("清理转码缓存失败：{}", e)
+
+    # 转码较慢，交由 transcode_music_files 在事件循环中异步完成
+    _pending_transcodes = pending
+
+    _playlist_lines = [f"{idx}: {info.title}" for idx, info in enumerate(music_files)]
+    _titles_norm = [info.norm for info in music_files]
+    _titles_py = [info.pinyin for info in music_files]
+    _titles_ini = [info.initials for info in music_files]
+    _filename_to_index = {info.filename: idx for idx, info in enumerate(music_files)}
+    _all_filenames = [info.filename for info in music_files]
+    _never_played = [fn for fn in _all_filenames if play_counts_by_filename.get(fn, 0) <= 0]
+    _never_played_pos = {fn: pos for pos, fn in enumerate(_never_played)}
+    _refresh_playable_indices()
+    logger.info("加载了 {} 首音乐文件", len(music_files))
+
+# 加载播放计数（先于扫描，扫描时据此生成未点播集合）
 load_play_counts()
 load_push_groups()
+# 初始化时加载音乐文件
+load_music_files()
+
+# 播放提示末尾的进度条装饰
+_PROGRESS_BAR = "●━━━━━━─────── 4:15"
+
+
+async def send_music(
+    send: Callable[[Any], Awaitable[Any]], banner: str, info: MusicEntry, file_uri: Optional[str] = None
+) -> None:
+    """发送播放提示与语音，全部方式失败时抛出异常。
+
+    语音消息无法与文字合并为一条发送，两次 API 调用并发进行，只等待一次往返。
+    优先发送 file:// URI，由 OneBot 实现直接读取本地文件；失败时小文件改用 base64。
+    同一首歌发往多个群时，可由调用方传入算好的 file_uri。
+    """
+    if file_uri is None:
+        file_uri = Path(info.path).absolute().as_uri()
+    audio_msg = MessageSegment.record(file=file_uri)
+    banner_result, audio_result = await asyncio.gather(send(banner), send(audio_msg), return_exceptions=True)
+    if isinstance(banner_result, Exception):
+        logger.warning("播放提示发送失败: {}", banner_result)
+    if not isinstance(audio_result, Exception):
+        return
+    err1 = str(audio_result)
+    logger.warning("方法1失败: {}", err1)
 
-def convert_audio_to_mp3(input_path: str) -> str:
-    """将音频文件转换为MP3格式"""
+    # 方法2：使用base64编码（仅限小文件，编码结果有缓存）
+    if info.size > _B64_FALLBACK_MAX_SIZE:
+        raise Exception(f"文件较大（{info.size/1024/1024:.1f}MB），无法改用 base64 方式发送。方法1错误: {err1}")
     try:
-        # 创建临时文件
-        with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as tmp_file:
-            output_path = tmp_file.name
-        
-        # 使用ffmpeg转换音频
-        cmd = [
-            'ffmpeg', '-i', input_path, 
-            '-acodec', 'libmp3lame', '-ab', '128k',
-            '-y', output_path
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            logger.info(f"音频转换成功: {input_path} -> {output_path}")
-            return output_path
-        else:
-            logger.error(f"音频转换失败: {result.stderr}")
-            return input_path
-    except Exception as e:
-        logger.error(f"音频转换异常: {str(e)}")
-        return input_path
+        audio_data = await _read_b64(info)
+        logger.info("base64编码完成，长度: {}", len(audio_data))
+        # 播放提示已随方法1发出，这里只补发语音
+        await send(MessageSegment.record(file=f"base64://{audio_data}"))
+        return
+    except Exception as e2:
+        err2 = str(e2)
+        logger.warning("方法2失败: {}", err2)
+
+    # 如果都失败了，确认文件是否已被移除后再报错
+    try:
+        os.stat(info.path)
+    except OSError:
+        raise Exception(f"音乐文件不存在：{info.title}")
+    raise Exception(f"所有发送方式都失败了。方法1错误: {err1}, 方法2错误: {err2}")
+
 
 # 歌单命令
 hachimi_playlist = on_command("哈基米歌单", aliases={"hachimi_playlist", "歌单"}, priority=5, block=True)
@@ -285,20 +756,16 @@ hachimi_playlist = on_command("哈基米歌单", aliases={"hachimi_playlist", "
 @hachimi_playlist.handle()
 async def handle_playlist(bot: Bot, event: GroupMessageEvent):
     """显示哈基米歌单（随机30首）"""
-    logger.info(f"收到歌单请求: {event.get_plaintext()}")
+    logger.info("收到歌单请求: {}", event.get_plaintext())
     
     if not music_files:
         await hachimi_playlist.finish("❌ 没有找到任何音乐文件，请在music_data文件夹中添加音乐文件。")
     
-    # 随机抽取30首
-    count = min(30, len(music_files))
-    all_items = list(music_files.items())
-    random_items = random.sample(all_items, k=count) if count > 0 else []
-
-    playlist_text = "🎵 哈基米歌单（随机30首） 🎵\n"
-    for index, music_info in random_items:
-        playlist_text += f"{index}: {music_info['title']}\n"
-    playlist_text += "\n输入 /哈基米点歌 <序号> 播放"
+    # 随机抽取30首（行文本在扫描时已生成）
+    count = min(30, len(_playlist_lines))
+    random_lines = random.sample(_playlist_lines, k=count)
+
+    playlist_text = "🎵 哈基米歌单（随机30首） 🎵\n" + "\n".join(random_lines) + "\n\n输入 /哈基米点歌 <序号> 播放"
     
     await hachimi_playlist.finish(playlist_text)
 
@@ -307,80 +774,45 @@ hachimi_play = on_command("哈基米点歌",priority=5, block=True)
 
 
 @hachimi_play.handle()
-async def handle_play(bot: Bot, event: GroupMessageEvent):
+async def handle_play(bot: Bot, event: GroupMessageEvent, args: Message = CommandArg()):
     """播放指定序号的音乐，并计入排行榜"""
-    logger.info(f"收到点歌请求: {event.get_plaintext()}")
-    
-    match = event.get_plaintext().strip()
-    number_match = re.search(r"(\d+)", match)
+    logger.info("收到点歌请求: {}", event.get_plaintext())
     
+    # CommandArg 已去掉命令前缀，参数整体必须是数字
+    number_match = _PLAY_RE.fullmatch(args.extract_plain_text())
     if not number_match:
         await hachimi_play.finish("❌ 请输入正确的序号格式：哈基米点歌 <序号>")
+    index = int(number_match.group(1))
     
-    try:
-        index = int(number_match.group(1))
-    except ValueError:
-        await hachimi_play.finish("❌ 序号必须是数字")
-    
-    if index not in music_files:
+    if not 0 <= index < len(music_files):
         await hachimi_play.finish(f"❌ 序号 {index} 不存在，请查看歌单获取正确的序号")
     
     music_info = music_files[index]
-    title = music_info['title']
-    file_path = music_info['path']
-    filename = music_info['filename']
-    
-    # 检查文件是否存在
-    if not os.path.exists(file_path):
-        await hachimi_play.finish(f"❌ 音乐文件不存在：{title}")
+    title = music_info.title
+    file_path = music_info.path
+    filename = music_info.filename
+    file_size = music_info.size
     
     # 计入排行榜（只要点播就+1）
     try:
         play_counts_by_filename[filename] = play_counts_by_filename.get(filename, 0) + 1
-        save_play_counts()
+        _discard_never_played(filename)
+        mark_play_counts_dirty()
     except Exception as e:
-        logger.warning(f"计数保存失败：{e}")
+        logger.warning("计数保存失败：{}", e)
     
-    # 检查文件大小
-    file_size = os.path.getsize(file_path)
-    max_size = 10 * 1024 * 1024  # 10MB
-    if file_size > max_size:
+    # 检查文件大小（扫描时已记录）
+    if file_size > _MAX_SEND_SIZE:
         await hachimi_play.finish(f"❌ 音乐文件过大（{file_size/1024/1024:.1f}MB），无法发送。请使用较小的音频文件。")
     
     try:
         # 尝试多种方式发送音频文件
-        logger.info(f"尝试播放文件: {file_path}")
-        logger.info(f"文件大小: {os.path.getsize(file_path)} bytes")
-        
-        # 方法1：直接使用文件路径
-        try:
-            audio_msg = MessageSegment.record(file=file_path)
-            await hachimi_play.send(f"正在为您播放：\n《{title}》\n●━━━━━━─────── 4:15")
-            await hachimi_play.send(audio_msg)
-            return
-        except Exception as e1:
-            logger.warning(f"方法1失败: {str(e1)}")
-        
-        # 方法2：使用base64编码
-        try:
-            with open(file_path, "rb") as f:
-                audio_data = base64.b64encode(f.read()).decode("utf-8")
-            
-            logger.info(f"base64编码完成，长度: {len(audio_data)}")
-            audio_msg = MessageSegment.record(file=f"base64://{audio_data}")
-            
-            await hachimi_play.send(f"正在为您播放：\n《{title}》\n●━━━━━━─────── 4:15")
-            await hachimi_play.send(audio_msg)
-            return
-        except Exception as e2:
-            logger.warning(f"方法2失败: {str(e2)}")
-        
-        # 如果都失败了，发送错误信息
-        raise Exception(f"所有发送方式都失败了。方法1错误: {str(e1)}, 方法2错误: {str(e2)}")
-        
+        logger.info("尝试播放文件: {}", file_path)
+        logger.info("文件大小: {} bytes", file_size)
+        await send_music(hachimi_play.send, f"正在为您播放：\n《{title}》\n{_PROGRESS_BAR}", music_info)
     except Exception as e:
-        logger.error(f"播放音乐失败: {str(e)}")
-        logger.error(f"错误类型: {type(e).__name__}")
+        logger.error("播放音乐失败: {}", e)
+        logger.error("错误类型: {}", type(e).__name__)
         await hachimi_play.finish(f"❌ 播放失败：{str(e)}")
 
 # 来首哈基米（随机播放一首）
@@ -392,39 +824,17 @@ async def handle_random_hachimi(bot: Bot, event: GroupMessageEvent):
     if not music_files:
         await random_hachimi.finish("❌ 没有找到任何音乐文件")
 
-    # 随机选择一首
-    all_items = list(music_files.items())
-    idx, music_info = random.choice(all_items)
-    title = music_info["title"]
-    file_path = music_info["path"]
+    if not _playable_indices:
+        await random_hachimi.finish("❌ 所有音乐文件都过大，无法发送。请使用较小的音频文件。")
 
-    if not os.path.exists(file_path):
-        await random_hachimi.finish(f"❌ 音乐文件不存在：{title}")
-
-    file_size = os.path.getsize(file_path)
-    max_size = 10 * 1024 * 1024
-    if file_size > max_size:
-        await random_hachimi.finish(f"❌ 音乐文件过大（{file_size/1024/1024:.1f}MB），无法发送。请使用较小的音频文件。")
+    # 只在可发送的曲目中随机选择一首（大小在扫描时已记录；文件若已被删除，发送失败时会提示）
+    music_info = music_files[random.choice(_playable_indices)]
+    title = music_info.title
 
     try:
-        # 方法1：直接路径
-        try:
-            await random_hachimi.send(f"来首哈基米：\n《{title}》\n●━━━━━━─────── 4:15")
-            await random_hachimi.send(MessageSegment.record(file=file_path))
-            return
-        except Exception as e1:
-            logger.warning(f"随机播放方法1失败: {e1}")
-        # 方法2：base64
-        try:
-            with open(file_path, "rb") as f:
-                audio_data = base64.b64encode(f.read()).decode("utf-8")
-            await random_hachimi.send(f"来首哈基米：\n《{title}》\n●━━━━━━─────── 4:15")
-            await random_hachimi.send(MessageSegment.record(file=f"base64://{audio_data}"))
-            return
-        except Exception as e2:
-            logger.warning(f"随机播放方法2失败: {e2}")
-        raise Exception("发送失败")
+        await send_music(random_hachimi.send, f"来首哈基米：\n《{title}》\n{_PROGRESS_BAR}", music_info)
     except Exception as e:
+        logger.warning("随机播放失败: {}", e)
         await random_hachimi.finish(f"❌ 播放失败：{e}")
 
 # 开启/关闭定时推送（仅超管/群主/群管）
@@ -472,43 +882,32 @@ async def handle_disable_push(bot: Bot, event: GroupMessageEvent):
     await disable_push_cmd.finish("✅ 已关闭本群哈基米定时推送")
 
 
-async def _push_one_group(bot: Bot, group_id: int, title: str, file_path: str, prefix: str) -> None:
+async def _push_one_group(bot: Bot, group_id: int, info: MusicEntry, banner: str, file_uri: str) -> None:
+    async def send(message: Any) -> Any:
+        return await bot.send_group_msg(group_id=group_id, message=message)
+
     try:
-        # 先发文本
-        await bot.send_group_msg(group_id=group_id, message=f"{prefix}\n《{title}》\n●━━━━━━─────── 4:15")
-        # 尝试音频
-        try:
-            await bot.send_group_msg(group_id=group_id, message=MessageSegment.record(file=file_path))
-            return
-        except Exception as e1:
-            logger.warning(f"群{group_id}推送方法1失败: {e1}")
-        try:
-            with open(file_path, "rb") as f:
-                audio_data = base64.b64encode(f.read()).decode("utf-8")
-            await bot.send_group_msg(group_id=group_id, message=MessageSegment.record(file=f"base64://{audio_data}"))
-        except Exception as e2:
-            logger.error(f"群{group_id}推送方法2失败: {e2}")
+        await send_music(send, banner, info, file_uri)
     except Exception as e:
-        logger.error(f"推送到群{group_id}失败: {e}")
+        logger.error("推送到群{}失败: {}", group_id, e)
 
 
 async def _push_random_to_enabled_groups(prefix: str) -> None:
     if not music_files or not enabled_push_groups:
         return
-    # 随机挑一首
-    idx, info = random.choice(list(music_files.items()))
-    title = info["title"]
-    file_path = info["path"]
-    if not os.path.exists(file_path):
+    if not _playable_indices:
         return
-    # 大小限制
-    max_size = 10 * 1024 * 1024
-    if os.path.getsize(file_path) > max_size:
-        return
-
+    # 在不超过大小限制的曲目中随机挑一首
+    info = music_files[random.choice(_playable_indices)]
+    title = info.title
+    file_path = info.path
+
+    # 提示文字与 URI 每轮只算一次；base64 回退只在首次失败时编码，之后各群命中 _read_b64 的缓存
+    banner = f"{prefix}\n《{title}》\n{_PROGRESS_BAR}"
+    file_uri = Path(file_path).absolute().as_uri()
     for bot_id, bot in get_bots().items():
         for gid in list(enabled_push_groups):
-            await _push_one_group(bot, gid, title, file_path, prefix)
+            await _push_one_group(bot, gid, info, banner, file_uri)
 
 
 def _register_cron_jobs() -> None:
@@ -533,7 +932,7 @@ def _register_cron_jobs() -> None:
             try:
                 await _push_random_to_enabled_groups(p)
             except Exception as e:
-                logger.error(f"哈基米定时推送执行失败：{e}")
+                logger.error("哈基米定时推送执行失败：{}", e)
 
         scheduler.add_job(job_runner, "cron", hour=hour, minute=minute, id=job_id, replace_existing=True)
 
@@ -541,6 +940,74 @@ def _register_cron_jobs() -> None:
 # 注册定时任务
 _register_cron_jobs()
 
+driver = get_driver()
+_background_tasks: Set[asyncio.Task] = set()
+
+
+_watch_stop: Optional[asyncio.Event] = None
+
+
+def _music_file_filter(change, path: str) -> bool:
+    """只关注 music_data 下的音频文件，忽略其他变化"""
+    stem, _, ext = os.path.basename(path).rpartition('.')
+    return bool(stem) and ext.lower() in _AUDIO_EXTS
+
+
+async def _watch_music_dir() -> None:
+    """监听音乐目录，文件增删改后自动重新扫描"""
+    async for changes in awatch(
+        music_data_path, watch_filter=_music_file_filter, recursive=False, stop_event=_watch_stop
+    ):
+        logger.info("检测到音乐目录变化（{} 项），重新扫描", len(changes))
+        try:
+            load_music_files()
+        except Exception as e:
+            logger.error("自动重载音乐文件失败：{}", e)
+            continue
+        # 转码放到后台，不阻塞后续的目录变化
+        _spawn_background(transcode_music_files())
+
+
+def _on_background_done(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("哈基米后台任务失败：{}", task.exception())
+
+
+def _spawn_background(coro) -> None:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_done)
+
+
+@driver.on_startup
+async def _start_background_tasks() -> None:
+    global _watch_stop
+    # 启动时在后台转码，避免拖慢 Bot 启动
+    _spawn_background(transcode_music_files())
+    if _WATCHFILES_AVAILABLE:
+        _watch_stop = asyncio.Event()
+        _spawn_background(_watch_music_dir())
+    else:
+        logger.info("未检测到 watchfiles，添加/删除音乐后请使用 /重载哈基米歌单 刷新")
+
+
+@driver.on_shutdown
+async def _stop_background_tasks() -> None:
+    if _watch_stop is not None:
+        _watch_stop.set()
+    # 取消后台转码（连同其中运行的 ffmpeg 进程）与目录监听
+    tasks = [*_background_tasks, *_inflight_transcodes.values()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if _aio_context is not None:
+        _aio_context.close()
+    # 写入尚未落盘的播放计数
+    if _counts_flush_handle is not None:
+        _counts_flush_handle.cancel()
+    flush_play_counts()
+
 # 重新加载音乐文件命令（管理员功能）
 reload_music = on_command("重载哈基米歌单", aliases={"reload_hachimi"}, priority=5, block=True)
 
@@ -549,6 +1016,9 @@ async def handle_reload(bot: Bot, event: GroupMessageEvent):
     """重新加载音乐文件"""
     logger.info("重新加载音乐文件")
     load_music_files()
+    if _pending_transcodes:
+        await reload_music.send(f"⏳ 正在转码 {len(_pending_transcodes)} 首非 MP3 音乐，请稍候…")
+        await transcode_music_files()
     count = len(music_files)
     await reload_music.finish(f"✅ 已重新加载音乐文件，共找到 {count} 首音乐")
 
@@ -559,7 +1029,7 @@ hachimi_rank = on_command("哈基米排行榜", aliases={"hachimi_rank", "排行
 async def handle_rank(bot: Bot, event: GroupMessageEvent):
     text = event.get_plaintext().strip()
     # 提取可选页码
-    m = re.search(r"(\d+)$", text)
+    m = _TRAILING_DIGITS_RE.search(text)
     page = 1
     if m:
         try:
@@ -572,26 +1042,27 @@ async def handle_rank(bot: Bot, event: GroupMessageEvent):
     if not music_files:
         await hachimi_rank.finish("❌ 没有找到任何音乐文件")
 
-    # 根据文件名计数构建排名（只统计被播放过的）
-    filename_to_index = {info['filename']: idx for idx, info in music_files.items()}
+    # 根据文件名计数构建排名（只统计被播放过的；文件名映射在扫描时已建好）
+    filename_to_index = _filename_to_index
 
-    played_items = [
+    played_items = (
         (fn, cnt) for fn, cnt in play_counts_by_filename.items() if cnt > 0 and fn in filename_to_index
-    ]
-    # 按次数降序，次数相同则按文件名升序
-    played_items.sort(key=lambda x: (-x[1], x[0]))
+    )
+    # 按次数降序，次数相同则按文件名升序；只需前 offset + page_size 名，用部分排序
+    top_items = heapq.nsmallest(offset + page_size, played_items, key=lambda x: (-x[1], x[0]))
 
     # 获取本页被播放过的条目
-    page_items: List[Tuple[str, int]] = played_items[offset: offset + page_size]
+    page_items: List[Tuple[str, int]] = top_items[offset: offset + page_size]
 
     # 若不足30条，用未上榜或剩余歌曲随机补齐
     needed = page_size - len(page_items)
     if needed > 0:
-        # 取所有可用文件名中未在本页的
-        already_fns = {fn for fn, _ in page_items}
-        # 为了避免越界，先取所有歌曲文件名
-        all_fns = [info['filename'] for _, info in music_files.items()]
-        candidates = [fn for fn in all_fns if fn not in already_fns]
+        # 优先从未点播的歌曲中抽取（本页条目均被播放过，不会重复）；不够时再从全部歌曲中取本页以外的
+        if len(_never_played) >= needed:
+            candidates = _never_played
+        else:
+            already_fns = {fn for fn, _ in page_items}
+            candidates = [fn for fn in _all_filenames if fn not in already_fns]
         if candidates:
             supplement = random.sample(candidates, k=min(needed, len(candidates)))
             page_items.extend((fn, play_counts_by_filename.get(fn, 0)) for fn in supplement)
@@ -603,7 +1074,7 @@ async def handle_rank(bot: Bot, event: GroupMessageEvent):
     rank_text = f"🏆 哈基米排行榜 第{page}页（每页30）\n"
     for i, (fn, cnt) in enumerate(page_items, start=1 + offset):
         idx = filename_to_index.get(fn, None)
-        title = music_files[idx]['title'] if idx in music_files else fn
+        title = music_files[idx].title if idx is not None else fn
         rank_text += f"{i}. {title}（序号{idx if idx is not None else '-'}） - {cnt} 次\n"
 
     rank_text += "\n输入 /哈基米点歌 <序号> 播放"
@@ -617,7 +1088,7 @@ async def handle_search(bot: Bot, event: GroupMessageEvent):
     text = event.get_plaintext().strip()
     # 去掉命令本身
     # 兼容：命令后直接空格关键词
-    query = re.sub(r"^\s*/?\s*(哈基米搜索|搜索|hachimi_search)\s*", "", text)
+    query = _SEARCH_STRIP_RE.sub("", text)
     query = query.strip()
 
     if not query:
@@ -626,16 +1097,27 @@ async def handle_search(bot: Bot, event: GroupMessageEvent):
     # 1) 纯数字直接按ID匹配
     if query.isdigit():
         idx = int(query)
-        if idx in music_files:
+        if idx < len(music_files):
             info = music_files[idx]
-            await hachimi_search.finish(f"找到ID对应曲目：\n{idx}: {info['title']}\n输入 /哈基米点歌 {idx} 播放")
+            await hachimi_search.finish(f"找到ID对应曲目：\n{idx}: {info.title}\n输入 /哈基米点歌 {idx} 播放")
         # 若ID不存在，则继续模糊搜索
 
-    # 2) 计算分数
+    # 2) 计算分数（查询的各种形式只算一次，标题特征在扫描时已算好）
+    q_norm = normalize_text(query)
+    q_py = text_to_pinyin(query)
+    q_ini = text_to_pinyin_initials(query)
+    q_regex = compile_user_regex(query)
     scored: List[tuple[int, float]] = []
-    for idx, info in music_files.items():
-        title = info['title']
-        score = compute_match_score(query, title)
+    # 分数 = 正则/子串命中分 + 相似度（规范化 ×0.8、拼音 ×0.6、首字母 ×0.5）
+    # 三种形式的相似度各用一次批量调用算完，循环内只剩正则与子串判断
+    sims_norm = batch_similarity(q_norm, _titles_norm)
+    sims_py = batch_similarity(q_py, _titles_py)
+    sims_ini = batch_similarity(q_ini, _titles_ini)
+    for idx, info in enumerate(music_files):
+        score = keyword_match_score(
+            q_norm, q_py, q_ini, q_regex, info.title, info.norm, info.pinyin, info.initials
+        )
+        score += sims_norm[idx] * 0.8 + sims_py[idx] * 0.6 + sims_ini[idx] * 0.5
         scored.append((idx, score))
 
     # 排序并截取前10
@@ -653,7 +1135,7 @@ async def handle_search(bot: Bot, event: GroupMessageEvent):
     result_text = "🔎 搜索结果（最多10条）：\n"
     for idx, score in top:
         info = music_files[idx]
-        result_text += f"{idx}: {info['title']}\n"
+        result_text += f"{idx}: {info.title}\n"
     result_text += "\n输入 /哈基米点歌 <序号> 播放"
 
     # 若pypinyin不可用，提示一次
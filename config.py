@@ -3,3 +3,7 @@ from pydantic import BaseModel
 
 class Config(BaseModel):
     """Plugin Config Here"""
+
+    # file:// 发送失败时改用 base64 兜底的文件大小上限（字节）。
+    # OneBot 实现无法读取机器人本地文件（如 Docker、远程部署）时只能走 base64，可按需调大
+    hachimi_base64_max_size: int = 2 * 1024 * 1024